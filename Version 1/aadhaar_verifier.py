@@ -1,94 +1,215 @@
-import os
 import re
 import base64
+import calendar
 import logging
-import tempfile
+import hashlib
+import shelve
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import certifi
 import urllib3
 import numpy as np
 from paddleocr import PaddleOCR
 from datetime import datetime
-from pdf2image import convert_from_path
-from fuzzywuzzy import fuzz
+import pymupdf
+from rapidfuzz import fuzz, process, utils
 import threading
+import queue
+from functools import lru_cache
+from operator import itemgetter
+from contextlib import nullcontext
+from concurrent.futures import ThreadPoolExecutor
 
 urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
-logging.basicConfig(level=logging.DEBUG, format="%(asctime)s - %(levelname)s - %(message)s")
+
+# Compiled once at import instead of being looked up on every OCR line
+_NAME_RE = re.compile(r"^[a-zA-Z\s]{3,}$")
+_TITLE_RE = re.compile(r"^(mr|ms|mrs)\.?\s*", re.I)
+_DOB_RE = re.compile(r"(\d{2}[/-]\d{2}[/-]\d{4})")
+# Formats accepted by normalize_dob: YYYY-MM-DD, DD-MM-YYYY and DD/MM/YYYY
+_DOB_FORMAT_RE = re.compile(r"^(\d{4})-(\d{1,2})-(\d{1,2})$|^(\d{1,2})([-/])(\d{1,2})\5(\d{4})$")
+_ISO_DATE_RE = re.compile(r"(\d{4})-(\d{2})-(\d{2})")
+# Plain substring alternation, same matches as the old any(w in l for w in EXCLUDE_WORDS)
+_EXCLUDE_RE = re.compile(r"dob|birth|male|female|government|uidai|year|india|authority|issue")
+
+class _DigitsOnly(dict):
+    # str.translate table that keeps decimal digits (what \d matches) and drops everything else.
+    # Each code point is classified once, after that translate() never leaves C.
+    def __missing__(self, codepoint):
+        self[codepoint] = codepoint if chr(codepoint).isdecimal() else None
+        return self[codepoint]
+
+_DIGITS_ONLY = _DigitsOnly()
+
+# One pooled session for all downloads/API calls, so TLS connections are kept alive across records
+http_session = requests.Session()
+http_session.mount("https://", HTTPAdapter(pool_connections=16, pool_maxsize=64, max_retries=Retry(total=2, backoff_factor=0.3)))
+
+# Process-wide OCR model for extractors created with shared_ocr=True, shared by every such extractor
+_shared_ocr = None
+_shared_ocr_lock = threading.Lock()
+
+# Optional on-disk cache of extraction results (see ocr_cache_path); shelve is not thread-safe on its own
+_ocr_disk_cache_lock = threading.Lock()
+
+# PyMuPDF is not thread-safe and holds the GIL while it renders, so every call into it is made under this
+# lock; the OCR calls between renders still run in parallel
+_pymupdf_lock = threading.Lock()
 
 class PaddleAadhaarExtractor:
-    def __init__(self, dpi=150):  # Reduced DPI for faster processing
+    def __init__(self, dpi=100, retry_dpi=200, cpu_threads=4, use_gpu=False, shared_ocr=False, onnx_dir=None, ocr_cache_path=None):  # Reduced DPI for faster processing
         self.dpi = dpi
+        self.retry_dpi = retry_dpi
+        self.cpu_threads = cpu_threads
+        self.use_gpu = use_gpu
+        self.shared_ocr = shared_ocr
+        self.onnx_dir = onnx_dir
+        self.ocr_cache_path = ocr_cache_path
         self._thread_local = threading.local()
 
     def get_ocr(self):
+        # One model per thread by default. shared_ocr=True uses the single process-wide model
+        # (one copy of the weights in memory); its ocr() calls are then serialised on _shared_ocr_lock
+        global _shared_ocr
+        if self.shared_ocr:
+            with _shared_ocr_lock:
+                if _shared_ocr is None:
+                    _shared_ocr = self._build_ocr()
+            return _shared_ocr
         if not hasattr(self._thread_local, "ocr"):
-            self._thread_local.ocr = PaddleOCR(use_angle_cls=False, lang='en')
+            self._thread_local.ocr = self._build_ocr()
         return self._thread_local.ocr
 
-    def image_from_pdf(self, pdf_path):
-        return convert_from_path(pdf_path, dpi=self.dpi)
+    def _build_ocr(self):
+        # lang='en' already resolves to the mobile det/rec models (en_PP-OCRv3_det, en_PP-OCRv4_rec).
+        # A card yields ~20-40 text boxes; recognising 16 per batch instead of paddle's default 6 cuts the
+        # number of recognizer runs per page
+        return PaddleOCR(use_angle_cls=False, lang='en', show_log=False, rec_batch_num=16, **self._backend_options())
+
+    def _backend_options(self):
+        if self.onnx_dir:
+            # det.onnx/rec.onnx/cls.onnx exported once with paddle2onnx, run on onnxruntime (needs onnxruntime installed)
+            return dict(
+                use_onnx=True,
+                det_model_dir=f"{self.onnx_dir}/det.onnx",
+                rec_model_dir=f"{self.onnx_dir}/rec.onnx",
+                cls_model_dir=f"{self.onnx_dir}/cls.onnx",
+            )
+        if self.use_gpu:
+            # TensorRT engine with FP16 kernels
+            return dict(use_gpu=True, use_tensorrt=True, precision='fp16')
+        # CPU inference with oneDNN; cpu_threads caps each model's math threads (paddle's default is 10),
+        # which otherwise oversubscribes the cores when several worker threads each own a model
+        return dict(use_gpu=False, enable_mkldnn=True, cpu_threads=self.cpu_threads)
+
+    # Kept per thread so threads sharing one extractor each read the raw result of their own OCR call
+    @property
+    def last_raw_ocr_result(self):
+        return getattr(self._thread_local, "last_raw_ocr_result", [])
+
+    @last_raw_ocr_result.setter
+    def last_raw_ocr_result(self, result):
+        self._thread_local.last_raw_ocr_result = result
+
+    def image_from_pdf(self, pdf, dpi=None):
+        # pdf is a file path or the raw PDF bytes.
+        # Opened eagerly so a broken PDF fails here; pages are only rendered as the caller asks for them
+        with _pymupdf_lock:
+            doc = pymupdf.open(stream=pdf, filetype="pdf") if isinstance(pdf, bytes) else pymupdf.open(pdf)
+        return self._render_pages(doc, dpi or self.dpi)
+
+    def _render_pages(self, doc, dpi):
+        # Rendered in-process by PyMuPDF, one page at a time, straight into a numpy buffer.
+        # The document is closed as soon as the caller stops iterating (early exit after page 1).
+        # The lock is held for the render only, never across a yield, so it is not held during OCR
+        try:
+            with _pymupdf_lock:
+                page_count = doc.page_count
+            for i in range(page_count):
+                with _pymupdf_lock:
+                    # 3-channel pixmap handed to PaddleOCR as is (it does no colour conversion on ndarrays).
+                    # pix.samples is the one copy out of MuPDF; samples_mv would dangle once pix is freed
+                    pix = doc[i].get_pixmap(dpi=dpi, alpha=False)
+                    image = np.frombuffer(pix.samples, dtype=np.uint8).reshape(pix.height, pix.width, 3)
+                yield image
+        finally:
+            with _pymupdf_lock:
+                doc.close()
 
     def extract_text_lines(self, image):
         ocr = self.get_ocr()
-        result = ocr.ocr(image, cls=False)  # Angle classifier disabled for speed
+        # A Paddle predictor must not run on two threads at once, so a shared model is locked
+        with _shared_ocr_lock if self.shared_ocr else nullcontext():
+            result = ocr.ocr(image, cls=False)  # Angle classifier disabled for speed
         self.last_raw_ocr_result = result
-        lines = [(line[1][0], line[0][1]) for block in result for line in block if line[1][0].strip()]
-        for line, _ in lines:
-            logging.debug(f"[OCR LINE] {line}")
+        # Repeated texts are kept once, at their first (top-most) box, and lines under 3 characters are
+        # dropped: no field extract_fields looks for is that short
+        first_box = {}
+        for block in result:
+            for box, (text, _) in block:
+                if len(text.strip()) >= 3:
+                    first_box.setdefault(text, box[1])
+        lines = list(first_box.items())
+        # Guarded so the per-line loop is skipped entirely unless DEBUG logging is on
+        if logging.getLogger().isEnabledFor(logging.DEBUG):
+            for line, _ in lines:
+                logging.debug("[OCR LINE] %s", line)
         return lines
 
     def extract_fields(self, lines, record=None):
         name_candidates = []
         dob_candidates = []
         aadhaar = ""
-        EXCLUDE_WORDS = ['dob', 'birth', 'male', 'female', 'government', 'uidai', 'year', 'india', 'authority', 'issue']
 
         for text, pos in lines:
             l = text.lower()
 
-            if re.search(r"^[a-zA-Z\s]{3,}$", text) and not any(w in l for w in EXCLUDE_WORDS):
-                cleaned = re.sub(r"^(mr|ms|mrs)\.?\s*", "", text, flags=re.I).strip()
+            if _NAME_RE.match(text) and not _EXCLUDE_RE.search(l):
+                cleaned = _TITLE_RE.sub("", text).strip()
                 name_candidates.append(cleaned)
 
-            if re.search(r"(\d{2}[/-]\d{2}[/-]\d{4})", text):
-                if not any(iss_kw in l for iss_kw in ["issue", "issued", "year of issue"]):
-                    match = re.search(r"(\d{2}[/-]\d{2}[/-]\d{4})", text)
-                    if match:
-                        dob_candidates.append((match.group(1), pos))
+            match = _DOB_RE.search(text)
+            if match and "issue" not in l:
+                dob_candidates.append((match.group(1), pos[1]))
 
-            if not aadhaar:
-                digits = re.sub(r"\D", "", text)
+            # A line shorter than 12 characters cannot hold the 12 digits, so it is not translated at all
+            if not aadhaar and len(text) >= 12:
+                digits = text.translate(_DIGITS_ONLY)
                 if len(digits) == 12:
                     aadhaar = digits
 
-        logging.debug(f"[DEBUG] DOB Candidates: {dob_candidates}")
+        logging.debug("[DEBUG] DOB Candidates: %s", dob_candidates)
 
         best_name = ""
-        name_score = 0
         if record:
-            full_name = f"{record.get('first_name', '')} {record.get('middle_name', '')} {record.get('last_name', '')}".strip().lower()
-            for candidate in name_candidates:
-                score = fuzz.token_set_ratio(candidate.lower(), full_name)
-                if score > name_score:
-                    best_name = candidate
-                    name_score = score
+            # extractOne scores every candidate in one C++ call; ties keep the earliest line.
+            # No length pre-filter: token_set_ratio scores a line holding only part of the name (e.g. the
+            # first name alone) as a full match, so short lines must stay in
+            best = process.extractOne(
+                record_full_name(record),
+                name_candidates,
+                scorer=fuzz.token_set_ratio,
+                processor=utils.default_process,
+            )
+            if best and best[1] > 0:
+                best_name = best[0]
         else:
             best_name = name_candidates[0] if name_candidates else ""
 
         parsed_dob = ""
-        sorted_dobs = sorted(dob_candidates, key=lambda x: x[1])
+        max_year = datetime.now().year - 5
+        # Top-most date first (candidates carry the y of their box)
+        sorted_dobs = sorted(dob_candidates, key=itemgetter(1))
         for dob, _ in sorted_dobs:
-            try:
-                parsed = datetime.strptime(dob.replace("/", "-"), "%d-%m-%Y").strftime("%Y-%m-%d")
-                year = int(parsed.split("-")[0])
-                if 1900 <= year <= datetime.now().year - 5:
-                    parsed_dob = parsed
+            # _DOB_RE already guarantees the DD?MM?YYYY digit layout, so slice instead of strptime
+            year = int(dob[6:])
+            if 1900 <= year <= max_year:
+                parsed_dob = _iso_date(year, int(dob[3:5]), int(dob[:2]))
+                if parsed_dob:
                     break
-            except:
-                continue
 
-        logging.debug(f"[DEBUG] Parsed DOB: {parsed_dob}")
+        logging.debug("[DEBUG] Parsed DOB: %s", parsed_dob)
 
         return {
             "Name": best_name,
@@ -96,53 +217,198 @@ class PaddleAadhaarExtractor:
             "Aadhaar Number": aadhaar
         }
 
-    def download_pdf_from_url(self, url):
+    def _fetch(self, url):
+        # Streaming GET on the shared keep-alive session, falling back to an unverified request on SSL errors
         try:
-            response = requests.get(url, verify=certifi.where(), timeout=10)
+            response = http_session.get(url, verify=certifi.where(), timeout=10, stream=True)
             response.raise_for_status()
         except requests.exceptions.SSLError:
-            response = requests.get(url, verify=False, timeout=10)
-        if response.status_code == 200:
-            temp_file = tempfile.NamedTemporaryFile(delete=False, suffix=".pdf")
-            temp_file.write(response.content)
-            temp_file.close()
-            return temp_file.name
-        raise Exception(f"Failed to download file: HTTP {response.status_code}")
+            response = http_session.get(url, verify=False, timeout=10, stream=True)
+        if response.status_code != 200:
+            response.close()
+            raise Exception(f"Failed to download file: HTTP {response.status_code}")
+        return response
+
+    def extract_from_pages(self, pages, record=None, rerender=None):
+        extracted = self._scan_pages(pages, record)
+        if rerender and not all(extracted.values()):
+            first_raw = self.last_raw_ocr_result
+            # The low default DPI reads most cards; only documents with a missing field pay for a
+            # second pass on pages re-rendered at retry_dpi
+            retried = self._scan_pages(rerender(), record)
+            if sum(map(bool, retried.values())) > sum(map(bool, extracted.values())):
+                extracted = retried
+            else:
+                # The raw OCR result reported is the one of the pass whose fields are kept
+                self.last_raw_ocr_result = first_raw
+        return extracted
+
+    def _scan_pages(self, pages, record=None):
+        for page in pages:
+            try:
+                lines = self.extract_text_lines(page)
+                extracted = self.extract_fields(lines, record)
+                if all(extracted.values()):
+                    return extracted
+            except Exception as e:
+                logging.warning(f"[PAGE ERROR] Skipped a page due to: {e}")
+                continue
+
+        return extracted if 'extracted' in locals() else {"Name": "", "DOB": "", "Aadhaar Number": ""}
 
     def extract_from_file(self, file_path_or_url, record=None):
-        temp_pdf_path = None
+        # Also takes the raw PDF bytes (e.g. already fetched with load_pdf); URLs are fetched into memory
+        source = file_path_or_url if isinstance(file_path_or_url, str) else "<PDF bytes>"
+        # Cleared first, so a download/render/OCR failure never reports the previous record's OCR result
+        self.last_raw_ocr_result = []
         try:
-            if file_path_or_url.startswith("http://") or file_path_or_url.startswith("https://"):
-                temp_pdf_path = self.download_pdf_from_url(file_path_or_url)
-                file_path = temp_pdf_path
-            else:
-                file_path = file_path_or_url
+            pdf = file_path_or_url
+            if isinstance(pdf, str) and (self.ocr_cache_path or pdf.startswith(("http://", "https://"))):
+                pdf = self.load_pdf(pdf)
+
+            # A document already read (same bytes, DPIs and applicant name) is answered from the disk cache
+            cache_key = self._disk_cache_key(pdf, record) if self.ocr_cache_path else None
+            if cache_key:
+                with _ocr_disk_cache_lock, shelve.open(self.ocr_cache_path) as disk:
+                    cached = disk.get(cache_key)
+                if cached:
+                    extracted, self.last_raw_ocr_result = cached
+                    return extracted
 
             try:
-                pages = self.image_from_pdf(file_path)
+                pages = self.image_from_pdf(pdf)
             except Exception as e:
-                logging.error(f"[PDF ERROR] Could not read PDF at {file_path}: {e}")
+                logging.error(f"[PDF ERROR] Could not read PDF at {source}: {e}")
                 return {"Name": "", "DOB": "", "Aadhaar Number": ""}
 
-            for page in pages:
-                try:
-                    lines = self.extract_text_lines(np.array(page))
-                    extracted = self.extract_fields(lines, record)
-                    if all(extracted.values()):
-                        return extracted
-                except Exception as e:
-                    logging.warning(f"[PAGE ERROR] Skipped a page due to: {e}")
-                    continue
-
-            return extracted if 'extracted' in locals() else {"Name": "", "DOB": "", "Aadhaar Number": ""}
+            extracted = self.extract_from_pages(pages, record, rerender=self._rerender(pdf))
+            # Nothing read (every page failed, or a transient OCR error) is not cached, so a rerun tries again
+            if cache_key and any(extracted.values()):
+                with _ocr_disk_cache_lock, shelve.open(self.ocr_cache_path) as disk:
+                    disk[cache_key] = (extracted, self.last_raw_ocr_result)
+            return extracted
 
         except Exception as e:
-            logging.error(f"[EXTRACTION ERROR] {file_path_or_url} → {e}")
+            logging.error(f"[EXTRACTION ERROR] {source} → {e}")
             return {"Name": "", "DOB": "", "Aadhaar Number": ""}
 
+    def _disk_cache_key(self, pdf, record):
+        # The applicant's name decides which OCR line is taken as the name, so it is part of the key
+        full_name = record_full_name(record) if record else ""
+        return f"{hashlib.sha256(pdf).hexdigest()}:{self.dpi}:{self.retry_dpi}:{full_name}"
+
+    def _rerender(self, pdf):
+        if not self.retry_dpi:
+            return None
+        return lambda: self.image_from_pdf(pdf, self.retry_dpi)
+
+    def load_pdf(self, file_path_or_url):
+        # Raw PDF bytes, so pages can be rendered and re-rendered from memory. URLs are read straight
+        # off the response; the bytes end up in memory either way, so a temp file would only add disk I/O
+        if file_path_or_url.startswith(("http://", "https://")):
+            with self._fetch(file_path_or_url) as response:
+                return response.content
+        with open(file_path_or_url, "rb") as f:
+            return f.read()
+
+    def pipeline(self, items, maxsize=8, downloaders=4, ocr_workers=1):
+        # items: iterable of (file_path_or_url, record); yields (record, extracted, raw_ocr_result).
+        # Download, PDF open, render+OCR/field extraction and the caller's own work run as four stages
+        # joined by bounded queues, so the OCR model keeps busy while the next PDFs are fetched and opened.
+        # With ocr_workers > 1 several threads (each with its own model) OCR at once; results then
+        # arrive in completion order rather than input order.
+        download_q = queue.Queue(maxsize=maxsize)
+        render_q = queue.Queue(maxsize=maxsize)
+        result_q = queue.Queue(maxsize=maxsize)
+        # Set once the caller stops iterating, so no stage stays blocked on a full (or empty) queue
+        stop = threading.Event()
+
+        def put(q, item):
+            while not stop.is_set():
+                try:
+                    q.put(item, timeout=0.1)
+                    return True
+                except queue.Full:
+                    pass
+            return False
+
+        def get(q):
+            # None (the end-of-stream sentinel) once stopped
+            while not stop.is_set():
+                try:
+                    return q.get(timeout=0.1)
+                except queue.Empty:
+                    pass
+            return None
+
+        def download_stage():
+            # Several downloads in flight at once; their futures are queued in input order
+            with ThreadPoolExecutor(max_workers=downloaders) as pool:
+                try:
+                    for file_path_or_url, record in items:
+                        if not put(download_q, (file_path_or_url, record, pool.submit(self.load_pdf, file_path_or_url))):
+                            break
+                finally:
+                    put(download_q, None)
+
+        def render_stage():
+            try:
+                while True:
+                    item = get(download_q)
+                    if item is None:
+                        break
+                    file_path_or_url, record, download = item
+                    try:
+                        pdf = download.result()
+                        # Opened here so a broken PDF fails early; pages stay a lazy generator and are
+                        # rendered in the OCR stage (one render at a time, see _pymupdf_lock), which stops
+                        # after the first page that reads every field
+                        pages = self.image_from_pdf(pdf)
+                    except Exception as e:
+                        logging.error(f"[PDF ERROR] Could not read PDF at {file_path_or_url}: {e}")
+                        pdf, pages = None, []
+                    put(render_q, (record, pdf, pages))
+            finally:
+                put(render_q, None)
+
+        def ocr_stage():
+            try:
+                while True:
+                    item = get(render_q)
+                    if item is None:
+                        # Passed on so every other OCR worker sees the end too
+                        put(render_q, None)
+                        break
+                    record, pdf, pages = item
+                    self.last_raw_ocr_result = []
+                    try:
+                        extracted = self.extract_from_pages(pages, record, rerender=pdf and self._rerender(pdf))
+                    except Exception as e:
+                        logging.error(f"[EXTRACTION ERROR] {e}")
+                        extracted = {"Name": "", "DOB": "", "Aadhaar Number": ""}
+                    put(result_q, (record, extracted, self.last_raw_ocr_result))
+            finally:
+                put(result_q, None)
+
+        for stage in (download_stage, render_stage) + (ocr_stage,) * ocr_workers:
+            threading.Thread(target=stage, daemon=True).start()
+
+        try:
+            running = ocr_workers
+            while running:
+                item = result_q.get()
+                if item is None:
+                    running -= 1
+                    continue
+                yield item
         finally:
-            if temp_pdf_path and os.path.exists(temp_pdf_path):
-                os.remove(temp_pdf_path)
+            # Also runs when the caller breaks out early or the generator is closed/collected
+            stop.set()
+
+# Fuzzy scores are cached per process: OCR lines and applicant names repeat a lot across a batch
+@lru_cache(maxsize=4096)
+def _name_score(full_name, extracted_name):
+    return max(fuzz.token_set_ratio(full_name, extracted_name, processor=utils.default_process), fuzz.ratio(full_name, extracted_name))
 
 def decode_base64_aadhaar(encoded):
     try:
@@ -150,45 +416,84 @@ def decode_base64_aadhaar(encoded):
     except Exception:
         return ""
 
+# Only the candidate fields the batch paths and verify_fields read; pass as the find() projection
+# so MongoDB doesn't ship (and pymongo doesn't decode) the rest of each document
+RECORD_PROJECTION = {
+    "auth_id": 1, "aadhaar_doc": 1, "aadhar_number": 1,
+    "first_name": 1, "middle_name": 1, "last_name": 1, "dateOfbirth": 1
+}
+
+# Per-record derived values, computed once and cached on the record dict itself: extract_fields runs
+# once per page/pass and verify_fields once more, all against the same applicant
+def record_full_name(record):
+    if "full_name_lower" not in record:
+        record["full_name_lower"] = f"{record.get('first_name', '')} {record.get('middle_name', '')} {record.get('last_name', '')}".strip().lower()
+    return record["full_name_lower"]
+
+def record_decoded_aadhaar(record):
+    if "decoded_aadhaar" not in record:
+        record["decoded_aadhaar"] = decode_base64_aadhaar(record.get("aadhar_number", ""))
+    return record["decoded_aadhaar"]
+
+def record_dob(record):
+    if "dob_normalized" not in record:
+        record["dob_normalized"] = normalize_dob(record.get("dateOfbirth", ""))
+    return record["dob_normalized"]
+
+def ocr_confidence(raw_result):
+    # Mean PaddleOCR score over the non-empty lines, summed in one pass (no list, no numpy round-trip)
+    total = count = 0
+    for block in raw_result or ():
+        for line in block or ():
+            if line[1][0].strip():
+                total += line[1][1]
+                count += 1
+    return total / count if count else 0.0
+
+def _iso_date(year, month, day):
+    # "YYYY-MM-DD" for a real calendar date, "" otherwise; no strptime and no exceptions
+    if year >= 1 and 1 <= month <= 12 and 1 <= day <= calendar.monthrange(year, month)[1]:
+        return f"{year:04d}-{month:02d}-{day:02d}"
+    return ""
+
 def normalize_dob(dob_str):
-    try:
-        for fmt in ("%Y-%m-%d", "%d-%m-%Y", "%d/%m/%Y"):
-            try:
-                return datetime.strptime(dob_str, fmt).strftime("%Y-%m-%d")
-            except:
-                continue
-    except:
-        return ""
+    # None when the record's DOB is missing or unparseable, so it can never equal an empty OCR DOB
+    match = _DOB_FORMAT_RE.fullmatch(dob_str) if isinstance(dob_str, str) else None
+    if not match:
+        return None
+    g = match.groups()
+    if g[0]:
+        return _iso_date(int(g[0]), int(g[1]), int(g[2])) or None
+    return _iso_date(int(g[6]), int(g[5]), int(g[3])) or None
+
+def format_dob(iso_dob):
+    # "YYYY-MM-DD" -> "DD-Mon-YYYY" (same output as strftime("%d-%b-%Y")); anything else comes back unchanged
+    match = _ISO_DATE_RE.fullmatch(iso_dob) if isinstance(iso_dob, str) else None
+    if not match or not 1 <= int(match.group(2)) <= 12:
+        return iso_dob
+    return f"{match.group(3)}-{calendar.month_abbr[int(match.group(2))]}-{match.group(1)}"
 
 def verify_fields(extracted, record):
-    full_name = f"{record.get('first_name', '')} {record.get('middle_name', '')} {record.get('last_name', '')}".strip().lower()
+    full_name = record_full_name(record)
     extracted_name = extracted["Name"].lower()
 
-    name_score = max(
-        fuzz.token_set_ratio(full_name, extracted_name),
-        fuzz.ratio(full_name, extracted_name)
-    )
+    name_score = _name_score(full_name, extracted_name)
     name_match = name_score >= 70
 
-    raw_dob = record.get("dateOfbirth", "")
-    dob_record = normalize_dob(raw_dob)
+    dob_record = record_dob(record)
     dob_extracted = extracted["DOB"]
 
     # Enhanced DOB logic with year-only match fallback
+    # Both sides are "YYYY-MM-DD" when present, so the year is the first four characters.
+    # Nothing to compare (no usable record DOB) is never a match
     dob_match = False
-    try:
-        if dob_extracted == dob_record:
-            dob_match = True
-        else:
-            record_year = datetime.strptime(dob_record, "%Y-%m-%d").year
-            extracted_year = datetime.strptime(dob_extracted, "%Y-%m-%d").year
-            if record_year == extracted_year:
-                logging.info(f"[DOB MATCH] Accepted by year match: DB={dob_record}, OCR={dob_extracted}")
-                dob_match = True
-    except:
-        pass
-
-    decoded_aadhaar = decode_base64_aadhaar(record.get("aadhar_number", ""))
+    if dob_record and dob_extracted == dob_record:
+        dob_match = True
+    elif dob_record and dob_extracted and dob_record[:4] == dob_extracted[:4]:
+        logging.info(f"[DOB MATCH] Accepted by year match: DB={dob_record}, OCR={dob_extracted}")
+        dob_match = True
+
+    decoded_aadhaar = record_decoded_aadhaar(record)
     aadhaar_extracted = extracted["Aadhaar Number"]
     aadhaar_match = aadhaar_extracted == decoded_aadhaar
 
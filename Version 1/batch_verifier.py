@@ -2,23 +2,24 @@ import base64
 import json
 import time
 import logging
+import threading
 import sys
 import psutil
 import multiprocessing
-from collections import Counter
+from collections import Counter, deque
 from datetime import datetime, timedelta
-from pymongo import MongoClient, ASCENDING
-import numpy as np
+from itertools import islice
+from pymongo import MongoClient, ASCENDING, ReplaceOne, UpdateOne
 import requests
-from concurrent.futures import ProcessPoolExecutor, as_completed
+from concurrent.futures import ThreadPoolExecutor
 from tqdm import tqdm
-from aadhaar_verifier import PaddleAadhaarExtractor, verify_fields, decode_base64_aadhaar
+from aadhaar_verifier import PaddleAadhaarExtractor, verify_fields, ocr_confidence, format_dob, record_decoded_aadhaar, record_full_name, record_dob, http_session, RECORD_PROJECTION
 
 # Setup loggingwil
 logging.getLogger("ppocr").setLevel(logging.ERROR)
 logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
 
-# MongoDB setup (moved to global scope so subprocesses can access)
+# MongoDB setup (global scope, one thread-safe client shared by the worker threads)
 client = MongoClient("mongodb://localhost:27017/")
 db = client["aadhar"]
 collection = db["cpetp_db.tbl_candidate(police_military)"]
@@ -28,10 +29,19 @@ verification_collection = db["verification_results"]
 BATCH_SIZE = 1200
 max_workers = 12
 
-# CLI override
-if len(sys.argv) >= 3:
-    BATCH_SIZE = int(sys.argv[1])
-    max_workers = int(sys.argv[2])
+# CLI override (--cache, anywhere on the line, keeps extracted fields in ocr_cache.db so re-runs skip OCR;
+# the file holds Aadhaar numbers, names and DOBs in plain text)
+use_cache = "--cache" in sys.argv
+cli_args = [a for a in sys.argv[1:] if a != "--cache"]
+if len(cli_args) >= 2:
+    BATCH_SIZE = int(cli_args[0])
+    max_workers = int(cli_args[1])
+
+# Shared by all worker threads; each thread warms its own OCR model once via the pool initializer
+extractor = PaddleAadhaarExtractor(ocr_cache_path="ocr_cache.db" if use_cache else None)
+
+# Ref-number lookups for accepted records, off the OCR workers' critical path
+ref_executor = ThreadPoolExecutor(max_workers=8)
 
 def generate_ref_number(decoded_aadhaar):
     url = 'https://aadhar.trti-maha.in:8080/'
@@ -41,7 +51,7 @@ def generate_ref_number(decoded_aadhaar):
         'entered_opr': 'struid'
     }
     try:
-        response = requests.post(url, data=data, timeout=30, verify=False)
+        response = http_session.post(url, data=data, timeout=30, verify=False)
         response.raise_for_status()
         json_data = response.json()
         return json_data.get("refnum", "N/A")
@@ -49,9 +59,67 @@ def generate_ref_number(decoded_aadhaar):
         logging.error(f"Error fetching Aadhaar ref number: {str(e)}")
         return "Error"
 
+# Ref numbers already fetched this run, by decoded Aadhaar, so a number repeated in the data is looked up once.
+# Only real ref numbers are kept; failures are retried next time
+ref_cache = {}
+
+def fetch_ref_number(decoded_aadhaar):
+    refnum = "notavailable"
+    if decoded_aadhaar:
+        if decoded_aadhaar in ref_cache:
+            return ref_cache[decoded_aadhaar]
+        fetched_ref = generate_ref_number(decoded_aadhaar)
+        if fetched_ref and fetched_ref not in ["N/A", "Error"]:
+            refnum = fetched_ref
+            ref_cache[decoded_aadhaar] = refnum
+            print(f" Aadhaar Ref Number: {refnum}")
+        else:
+            print(" Aadhaar reference number Not Available.")
+    else:
+        print(" Decoded Aadhaar number missing, setting refnum as 'notavailable'.")
+    return refnum
+
+def collect_ref_numbers(results):
+    # Waits for the background ref-number lookups and stores each one on its result
+    for r in results:
+        future = r.pop("_refnum_future", None)
+        if future is not None:
+            try:
+                r["aadhaar_ref_number"] = future.result()
+            except Exception as e:
+                logging.error(f"{r.get('auth_id')} Ref number lookup failed: {e}")
+                r["aadhaar_ref_number"] = "notavailable"
+
+def fetch_pdf(record):
+    # Raw PDF bytes for a record, or None if it has no document or the download keeps failing
+    aadhaar_path = record.get("aadhaar_doc")
+    if not aadhaar_path:
+        return None
+    aadhaar_url = f"https://cpetp.trti-maha.in/{aadhaar_path}"
+    for attempt in range(2):
+        try:
+            return extractor.load_pdf(aadhaar_url)
+        except Exception as e:
+            if attempt == 1:
+                logging.error(f"{record.get('auth_id')} PDF download failed: {e}")
+                return None
+            time.sleep(1)
+
+def prefetch(records, n=8):
+    # Yields (record, pdf) in order while up to n downloads run ahead, so OCR workers never wait on the network
+    with ThreadPoolExecutor(max_workers=n) as downloader:
+        pending = deque()
+        for record in records:
+            pending.append((record, downloader.submit(fetch_pdf, record)))
+            if len(pending) >= n:
+                record, future = pending.popleft()
+                yield record, future.result()
+        while pending:
+            record, future = pending.popleft()
+            yield record, future.result()
+
 def process_record(record_tuple):
-    record, i, total = record_tuple
-    extractor = PaddleAadhaarExtractor()
+    record, pdf, i, total = record_tuple
     start_time = time.time()
 
     try:
@@ -60,37 +128,28 @@ def process_record(record_tuple):
             print(f"[{i+1}] {record.get('auth_id')} Missing Aadhaar path.")
             return None
 
-        aadhaar_url = f"https://cpetp.trti-maha.in/{aadhaar_path}"
-        for attempt in range(2):
-            try:
-                extracted = extractor.extract_from_file(aadhaar_url, record)
-                break
-            except Exception as e:
-                if attempt == 1:
-                    logging.error(f"[{i+1}] Final extraction failure: {e}")
-                    return None
-                time.sleep(1)
+        # Derived per-record values are cached on the record before OCR so extraction and verification reuse them
+        decoded_aadhaar = record_decoded_aadhaar(record)
+        record_full_name(record)
+        record_dob(record)
+
+        if pdf is None:
+            # Still verified (with nothing extracted) and saved, so the record lands in Manual_Review
+            logging.error(f"[{i+1}] Final extraction failure: PDF could not be downloaded")
+            extractor.last_raw_ocr_result = []
+            extracted = {"Name": "", "DOB": "", "Aadhaar Number": ""}
+        else:
+            extracted = extractor.extract_from_file(pdf, record)
 
-        decoded_aadhaar = decode_base64_aadhaar(record.get("aadhar_number", ""))
-        record["decoded_aadhaar"] = decoded_aadhaar
         result = verify_fields(extracted, record)
 
-        try:
-            raw_lines = extractor.last_raw_ocr_result
-            confidences = [line[1][1] for block in raw_lines for line in block if line[1][0].strip()]
-            avg_confidence = float(np.mean(confidences)) if confidences else 0.0
-        except:
-            avg_confidence = 0.0
+        avg_confidence = ocr_confidence(extractor.last_raw_ocr_result)
 
         decision_raw = result["decision"]
         decision = decision_raw.strip().lower()
         aadhaar_status = "Verified" if decision == "accept" else "Not Verified"
 
-        dob_raw = extracted.get("DOB", "")
-        try:
-            dob_formatted = datetime.strptime(dob_raw, "%Y-%m-%d").strftime("%d-%b-%Y")
-        except:
-            dob_formatted = dob_raw
+        dob_formatted = format_dob(extracted.get("DOB", ""))
 
         result_entry = {
             "auth_id": record.get("auth_id"),
@@ -110,17 +169,8 @@ def process_record(record_tuple):
         }
 
         if decision == "accept":
-            refnum = "notavailable"
-            if decoded_aadhaar:
-                fetched_ref = generate_ref_number(decoded_aadhaar)
-                if fetched_ref and fetched_ref not in ["N/A", "Error"]:
-                    refnum = fetched_ref
-                    print(f" Aadhaar Ref Number: {refnum}")
-                else:
-                    print(" Aadhaar reference number Not Available.")
-            else:
-                print(" Decoded Aadhaar number missing, setting refnum as 'notavailable'.")
-            result_entry["aadhaar_ref_number"] = refnum
+            # The ref-number API call runs in the background; the batch loop collects it before the DB write
+            result_entry["_refnum_future"] = ref_executor.submit(fetch_ref_number, decoded_aadhaar)
 
         print(
             f"[{i+1}/{total}] {record.get('auth_id')} → {decision_raw} | aadhaar_status={aadhaar_status} | "
@@ -131,42 +181,44 @@ def process_record(record_tuple):
         )
         print(f" Time taken: {time.time() - start_time:.2f} seconds\n")
 
-        # --- Immediate DB write ---
-        if decision == "accept":
-            base64_aadhaar = base64.b64encode(decoded_aadhaar.encode()).decode()
-            name_parts = extracted.get("Name", "").strip().split()
-            extracted_name_parts = (name_parts + ["", "", ""])[:3]
-
-            collection.update_one(
-                {"aadhar_number": base64_aadhaar},
-                {"$set": {
-                    "aadhaar_status": aadhaar_status,
-                    "aadhaar_ref_number": result_entry.get("aadhaar_ref_number", ""),
-                    "verified_by": result_entry.get("verified_by", "Mihir"),
-                    "verifier_role": result_entry.get("verifier_role", "AI"),
-                    "first_name": extracted_name_parts[0],
-                    "middle_name": extracted_name_parts[1],
-                    "last_name": extracted_name_parts[2],
-                    "dateOfbirth": result_entry["extracted_dob"],
-                    "aadhar_number": base64.b64encode(result_entry["extracted_aadhaar"].encode()).decode()
-                }}
-            )
-        else:
-            verification_collection.replace_one(
-                {"decoded_aadhaar": decoded_aadhaar}, result_entry, upsert=True
-            )
-
         return result_entry
 
     except Exception as e:
         logging.error(f"[{i+1}] {record.get('auth_id')} Error: {e}")
         return None
 
+# DB write for one result; accepted records update the candidate, the rest go to verification_results.
+# Ops are collected per batch and sent with one bulk_write per collection instead of a round-trip per record
+def build_write_op(result_entry):
+    decoded_aadhaar = result_entry["decoded_aadhaar"]
+    if result_entry["aadhaar_status"] != "Verified":
+        return ReplaceOne({"decoded_aadhaar": decoded_aadhaar}, result_entry, upsert=True)
+
+    base64_aadhaar = base64.b64encode(decoded_aadhaar.encode()).decode()
+    name_parts = result_entry["extracted_name"].strip().split()
+    extracted_name_parts = (name_parts + ["", "", ""])[:3]
+
+    return UpdateOne(
+        {"aadhar_number": base64_aadhaar},
+        {"$set": {
+            "aadhaar_status": result_entry["aadhaar_status"],
+            "aadhaar_ref_number": result_entry.get("aadhaar_ref_number", ""),
+            "verified_by": result_entry.get("verified_by", "Mihir"),
+            "verifier_role": result_entry.get("verifier_role", "AI"),
+            "first_name": extracted_name_parts[0],
+            "middle_name": extracted_name_parts[1],
+            "last_name": extracted_name_parts[2],
+            "dateOfbirth": result_entry["extracted_dob"],
+            "aadhar_number": base64.b64encode(result_entry["extracted_aadhaar"].encode()).decode()
+        }}
+    )
+
 def run_batch_verification():
     start_batch = time.time()
 
     # Create indexes for performance
     collection.create_index([("aadhar_number", ASCENDING)])
+    collection.create_index([("aadhaar_status", ASCENDING)])
     verification_collection.create_index([("auth_id", ASCENDING)], unique=True)
     verification_collection.create_index([("decoded_aadhaar", ASCENDING)], unique=True)
 
@@ -177,10 +229,17 @@ def run_batch_verification():
     manual_review_total = 0
     processed_so_far = 0
 
+    # One worker pool for the whole run: each worker thread loads its OCR model once, not once per batch
+    executor = ThreadPoolExecutor(max_workers=max_workers, initializer=extractor.get_ocr)
+
+    # One cursor for the whole run, taken BATCH_SIZE records at a time. Records left at manual review keep
+    # no aadhaar_status, so re-running the query per batch would fetch them again; a batch can take longer
+    # than the server's 10-minute idle cursor timeout, hence no_cursor_timeout (closed after the loop)
+    cursor = collection.find(
+        {"aadhaar_status": {"$exists": False}}, RECORD_PROJECTION, no_cursor_timeout=True
+    ).batch_size(BATCH_SIZE)
     while True:
-        applicants = list(collection.find({
-            "aadhaar_status": {"$exists": False}
-        }).limit(BATCH_SIZE))
+        applicants = list(islice(cursor, BATCH_SIZE))
 
         if not applicants:
             break
@@ -188,18 +247,47 @@ def run_batch_verification():
         logging.info(f"\n🔁 Processing batch of {len(applicants)} records (processed so far: {processed_so_far})")
 
         results = []
-        with ProcessPoolExecutor(max_workers=max_workers) as executor:
-            futures = {
-                executor.submit(process_record, (record, i + processed_so_far, total)): i
-                for i, record in enumerate(applicants)
-            }
-
-            for future in tqdm(as_completed(futures), total=len(futures), desc="🔄 Verifying", dynamic_ncols=True, leave=True):
-
+        with tqdm(total=len(applicants), desc="🔄 Verifying", dynamic_ncols=True, leave=True) as progress:
+            # Downloaded PDFs waiting for an OCR worker are capped at 2 x max_workers
+            window = threading.BoundedSemaphore(max_workers * 2)
+
+            def on_done(_):
+                window.release()
+                progress.update()
+
+            futures = []
+            # Download look-ahead grows with the worker count (CLI-configurable), so a large pool is never starved
+            for i, (record, pdf) in enumerate(prefetch(applicants, n=max(8, max_workers))):
+                window.acquire()
+                future = executor.submit(process_record, (record, pdf, i + processed_so_far, total))
+                future.add_done_callback(on_done)
+                futures.append(future)
+
+            for future in futures:
                 result = future.result()
                 if result:
                     results.append(result)
 
+        collect_ref_numbers(results)
+
+        # --- Batched DB write ---
+        candidate_ops, verification_ops = [], []
+        for r in results:
+            op = build_write_op(r)
+            (candidate_ops if isinstance(op, UpdateOne) else verification_ops).append(op)
+        # Unordered, so one bad document doesn't stop the rest; each collection is written on its own so a
+        # failure on one can't drop the other's writes. Errors are logged and the run carries on
+        if candidate_ops:
+            try:
+                collection.bulk_write(candidate_ops, ordered=False)
+            except Exception as e:
+                logging.warning(f"⚠️ Error writing {len(candidate_ops)} verified candidates: {e}")
+        if verification_ops:
+            try:
+                verification_collection.bulk_write(verification_ops, ordered=False)
+            except Exception as e:
+                logging.warning(f"⚠️ Error writing {len(verification_ops)} manual review results: {e}")
+
         verified_count = sum(1 for r in results if r["decision"].strip().lower() == "accept")
         manual_review_count = len(results) - verified_count
 
@@ -217,6 +305,9 @@ def run_batch_verification():
 
         logging.info(f"✅ Batch completed: Verified={verified_count}, Manual={manual_review_count}")
 
+    cursor.close()
+    executor.shutdown()
+
     total_time_sec = time.time() - start_batch
     print(f"\n✅ All batches completed in {total_time_sec:.2f} seconds")
     print(f"🔢 Total unverified records processed: {processed_so_far}")
@@ -2,19 +2,25 @@ import base64
 import json
 import time
 import logging
-from collections import Counter
-from datetime import datetime
-from pymongo import MongoClient, ASCENDING
-import numpy as np
+import threading
+import sys
+from collections import Counter, deque
+from pymongo import MongoClient, ASCENDING, ReplaceOne
 import requests
-from concurrent.futures import ProcessPoolExecutor, as_completed
-from aadhaar_verifier import PaddleAadhaarExtractor, verify_fields, decode_base64_aadhaar
+from concurrent.futures import ThreadPoolExecutor
+from aadhaar_verifier import PaddleAadhaarExtractor, verify_fields, ocr_confidence, format_dob, record_decoded_aadhaar, record_full_name, record_dob, http_session, RECORD_PROJECTION
 
 # Setup logging
 logging.getLogger("ppocr").setLevel(logging.ERROR)
 logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
 
-extractor = PaddleAadhaarExtractor()
+# Shared by all worker threads; each thread warms its own OCR model once via the pool initializer.
+# With --cache, extracted fields are kept in ocr_cache.db so re-runs skip OCR for documents already read
+# (the file holds Aadhaar numbers, names and DOBs in plain text)
+extractor = PaddleAadhaarExtractor(ocr_cache_path="ocr_cache.db" if "--cache" in sys.argv else None)
+
+# Ref-number lookups for accepted records, off the OCR workers' critical path
+ref_executor = ThreadPoolExecutor(max_workers=8)
 
 def generate_ref_number(decoded_aadhaar):
     url = 'https://aadhar.trti-maha.in:8080/'
@@ -24,7 +30,7 @@ def generate_ref_number(decoded_aadhaar):
         'entered_opr': 'struid'
     }
     try:
-        response = requests.post(url, data=data, timeout=30, verify=False)
+        response = http_session.post(url, data=data, timeout=30, verify=False)
         response.raise_for_status()
         json_data = response.json()
         return json_data.get("refnum", "N/A")
@@ -32,9 +38,67 @@ def generate_ref_number(decoded_aadhaar):
         logging.error(f"Error fetching Aadhaar ref number: {str(e)}")
         return "Error"
 
+# Ref numbers already known, by decoded Aadhaar: seeded from earlier runs' results and filled by each
+# successful lookup, so the external API is asked once per number. Failures are not kept
+ref_cache = {}
+
+def fetch_ref_number(decoded_aadhaar):
+    refnum = "notavailable"
+    if decoded_aadhaar:
+        if decoded_aadhaar in ref_cache:
+            return ref_cache[decoded_aadhaar]
+        fetched_ref = generate_ref_number(decoded_aadhaar)
+        if fetched_ref and fetched_ref not in ["N/A", "Error"]:
+            refnum = fetched_ref
+            ref_cache[decoded_aadhaar] = refnum
+            print(f"\U0001F4CC Aadhaar Ref Number: {refnum}")
+        else:
+            print("\u26A0\uFE0F Aadhaar reference number Not Available.")
+    else:
+        print("\u26A0\uFE0F Decoded Aadhaar number missing, setting refnum as 'notavailable'.")
+    return refnum
+
+def collect_ref_numbers(results):
+    # Waits for the background ref-number lookups and stores each one on its result
+    for r in results:
+        future = r.pop("_refnum_future", None)
+        if future is not None:
+            try:
+                r["aadhaar_refnum"] = future.result()
+            except Exception as e:
+                logging.error(f"{r.get('auth_id')} Ref number lookup failed: {e}")
+                r["aadhaar_refnum"] = "notavailable"
+
+def fetch_pdf(record):
+    # Raw PDF bytes for a record, or None if it has no document or the download keeps failing
+    aadhaar_path = record.get("aadhaar_doc")
+    if not aadhaar_path:
+        return None
+    aadhaar_url = f"https://cpetp.trti-maha.in/{aadhaar_path}"
+    for attempt in range(2):
+        try:
+            return extractor.load_pdf(aadhaar_url)
+        except Exception as e:
+            if attempt == 1:
+                logging.error(f"{record.get('auth_id')} PDF download failed: {e}")
+                return None
+            time.sleep(1)
+
+def prefetch(records, n=8):
+    # Yields (record, pdf) in order while up to n downloads run ahead, so OCR workers never wait on the network
+    with ThreadPoolExecutor(max_workers=n) as downloader:
+        pending = deque()
+        for record in records:
+            pending.append((record, downloader.submit(fetch_pdf, record)))
+            if len(pending) >= n:
+                record, future = pending.popleft()
+                yield record, future.result()
+        while pending:
+            record, future = pending.popleft()
+            yield record, future.result()
+
 def process_record(record_tuple):
-    record, i, total = record_tuple
-    extractor = PaddleAadhaarExtractor()  # Each process gets its own instance
+    record, pdf, i, total = record_tuple
     start_time = time.time()
     try:
         aadhaar_path = record.get("aadhaar_doc")
@@ -42,37 +106,28 @@ def process_record(record_tuple):
             print(f"[{i+1}] {record.get('auth_id')} Missing Aadhaar path.")
             return None
 
-        aadhaar_url = f"https://cpetp.trti-maha.in/{aadhaar_path}"
-        for attempt in range(2):
-            try:
-                extracted = extractor.extract_from_file(aadhaar_url, record)
-                break
-            except Exception as e:
-                if attempt == 1:
-                    logging.error(f"[{i+1}] Final extraction failure: {e}")
-                    return None
-                time.sleep(1)
+        # Derived per-record values are cached on the record before OCR so extraction and verification reuse them
+        decoded_aadhaar = record_decoded_aadhaar(record)
+        record_full_name(record)
+        record_dob(record)
+
+        if pdf is None:
+            # Still verified (with nothing extracted) and saved, so the record lands in Manual_Review
+            logging.error(f"[{i+1}] Final extraction failure: PDF could not be downloaded")
+            extractor.last_raw_ocr_result = []
+            extracted = {"Name": "", "Gender": "", "DOB": "", "Aadhaar Number": ""}
+        else:
+            extracted = extractor.extract_from_file(pdf, record)
 
-        decoded_aadhaar = decode_base64_aadhaar(record.get("aadhar_number", ""))
-        record["decoded_aadhaar"] = decoded_aadhaar
         result = verify_fields(extracted, record)
 
-        try:
-            raw_lines = extractor.last_raw_ocr_result
-            confidences = [line[1][1] for block in raw_lines for line in block if line[1][0].strip()]
-            avg_confidence = float(np.mean(confidences)) if confidences else 0.0
-        except:
-            avg_confidence = 0.0
+        avg_confidence = ocr_confidence(extractor.last_raw_ocr_result)
 
         decision_raw = result["decision"]
         decision = decision_raw.strip().lower()
         status = "Verified" if decision == "accept" else "Not Verified"
 
-        dob_raw = extracted.get("DOB", "")
-        try:
-            dob_formatted = datetime.strptime(dob_raw, "%Y-%m-%d").strftime("%d-%b-%Y")
-        except:
-            dob_formatted = dob_raw
+        dob_formatted = format_dob(extracted.get("DOB", ""))
 
         result_entry = {
             "auth_id": record.get("auth_id"),
@@ -91,17 +146,8 @@ def process_record(record_tuple):
         }
 
         if decision == "accept":
-            refnum = "notavailable"
-            if decoded_aadhaar:
-                fetched_ref = generate_ref_number(decoded_aadhaar)
-                if fetched_ref and fetched_ref not in ["N/A", "Error"]:
-                    refnum = fetched_ref
-                    print(f"\U0001F4CC Aadhaar Ref Number: {refnum}")
-                else:
-                    print("\u26A0\uFE0F Aadhaar reference number Not Available.")
-            else:
-                print("\u26A0\uFE0F Decoded Aadhaar number missing, setting refnum as 'notavailable'.")
-            result_entry["aadhaar_refnum"] = refnum
+            # The ref-number API call runs in the background; the batch loop collects it before the DB write
+            result_entry["_refnum_future"] = ref_executor.submit(fetch_ref_number, decoded_aadhaar)
 
         print(
             f"[{i+1}/{total}] {record.get('auth_id')} → {decision_raw} | Status={status} | "
@@ -120,6 +166,21 @@ def process_record(record_tuple):
         logging.error(f"[{i+1}] {record.get('auth_id')} Error: {e}")
         return None
 
+# Results are written every WRITE_BATCH records, so memory stays flat and a crash loses at most one chunk
+WRITE_BATCH = 500
+
+def save_results(verification_collection, results):
+    collect_ref_numbers(results)
+    try:
+        # One bulk round-trip instead of a replace_one per record
+        verification_collection.bulk_write(
+            [ReplaceOne({"decoded_aadhaar": r["decoded_aadhaar"]}, r, upsert=True) for r in results],
+            ordered=False
+        )
+        logging.info(f"✅ Saved {len(results)} results to 'verification_results'")
+    except Exception as e:
+        logging.warning(f"⚠\uFE0F Error inserting results: {e}")
+
 def run_batch_verification():
     start_batch = time.time()
 
@@ -132,33 +193,55 @@ def run_batch_verification():
     verification_collection.create_index([("auth_id", ASCENDING)], unique=True)
     verification_collection.create_index([("decoded_aadhaar", ASCENDING)], unique=True)
 
-    applicants = list(collection.find({}))
-    total = len(applicants)
+    # Ref numbers stored by earlier runs are reused instead of asking the API again
+    ref_cache.update(
+        (doc["decoded_aadhaar"], doc["aadhaar_refnum"])
+        for doc in verification_collection.find(
+            {"aadhaar_refnum": {"$exists": True, "$nin": ["notavailable", "N/A", "Error"]}},
+            {"_id": 0, "decoded_aadhaar": 1, "aadhaar_refnum": 1}
+        )
+    )
+
+    total = collection.count_documents({})
     logging.info(f"Total records fetched from MongoDB: {total}")
 
-    results = []
-    with ProcessPoolExecutor(max_workers=4) as executor:
-        futures = {
-            executor.submit(process_record, (record, i, total)): i
-            for i, record in enumerate(applicants)
-        }
-        for future in as_completed(futures):
-            result = future.result()
-            if result:
-                results.append(result)
+    # Running tallies for the accuracy report instead of keeping every result until the end
+    decision_counts = Counter()
+    field_counts = Counter()
+    pending = []
 
-    if results:
-        try:
-            for r in results:
-                verification_collection.replace_one(
-                    {"decoded_aadhaar": r["decoded_aadhaar"]},
-                    r,
-                    upsert=True
-                )
-            logging.info(f"✅ Saved {len(results)} results to 'verification_results'")
-        except Exception as e:
-            logging.warning(f"⚠\uFE0F Error inserting results: {e}")
-    else:
+    def tally(result):
+        if not result:
+            return
+        decision_counts[result["decision"].strip().lower()] += 1
+        for field in ["name_match", "dob_match", "gender_match", "aadhaar_match"]:
+            field_counts[field] += result[field]
+        pending.append(result)
+        if len(pending) >= WRITE_BATCH:
+            save_results(verification_collection, pending)
+            pending.clear()
+
+    # Streamed from the cursor rather than loaded up front; a run can outlast the server's idle cursor timeout
+    with collection.find({}, RECORD_PROJECTION, no_cursor_timeout=True).batch_size(500) as applicants, \
+            ThreadPoolExecutor(max_workers=4, initializer=extractor.get_ocr) as executor:
+        # Downloaded PDFs waiting for an OCR worker are capped at 8
+        window = threading.BoundedSemaphore(8)
+        futures = deque()
+        for i, (record, pdf) in enumerate(prefetch(applicants)):
+            window.acquire()
+            future = executor.submit(process_record, (record, pdf, i, total))
+            future.add_done_callback(lambda _: window.release())
+            futures.append(future)
+            # Finished records are taken off the front in order as the run goes
+            while futures and futures[0].done():
+                tally(futures.popleft().result())
+        while futures:
+            tally(futures.popleft().result())
+
+    if pending:
+        save_results(verification_collection, pending)
+    processed = sum(decision_counts.values())
+    if not processed:
         logging.warning("❌ No results to insert.")
 
     total_time_sec = time.time() - start_batch
@@ -166,15 +249,13 @@ def run_batch_verification():
     print(f"\n🗓️ Total time taken: {total_time_sec:.2f} seconds")
 
     print("\nAccuracy Report")
-    if results:
-        decisions = [r['decision'].strip().lower() for r in results]
-        counts = Counter(decisions)
-        print(f"Verified (Accept)         : {counts.get('accept', 0)} ({counts.get('accept', 0)/len(results):.2%})")
-        print(f"Not Verified (Manual Review): {counts.get('manual_review', 0)} ({counts.get('manual_review', 0)/len(results):.2%})")
+    if processed:
+        print(f"Verified (Accept)         : {decision_counts['accept']} ({decision_counts['accept']/processed:.2%})")
+        print(f"Not Verified (Manual Review): {decision_counts['manual_review']} ({decision_counts['manual_review']/processed:.2%})")
 
         print("\nField-Level Accuracy")
         for field in ["name_match", "dob_match", "gender_match", "aadhaar_match"]:
-            percent = sum(r[field] for r in results) / len(results)
+            percent = field_counts[field] / processed
             print(f"{field:<15}: {percent:.2%}")
     else:
         print("No records processed.")
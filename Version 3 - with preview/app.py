@@ -1,15 +1,13 @@
 from flask import Flask, request, jsonify, render_template
 from flask_cors import CORS
-from aadhaar_verifier import PaddleAadhaarExtractor, verify_fields, decode_base64_aadhaar
-from pymongo import MongoClient
-from concurrent.futures import ThreadPoolExecutor, as_completed
+from aadhaar_verifier import PaddleAadhaarExtractor, verify_fields, ocr_confidence, format_dob, record_decoded_aadhaar, RECORD_PROJECTION, http_session
+from pymongo import MongoClient, ASCENDING, ReplaceOne
 from datetime import datetime
 from werkzeug.utils import secure_filename
+import base64
 import logging
-import numpy as np
 import os
 import time
-import requests
 
 app = Flask(__name__)
 CORS(app)
@@ -25,9 +23,24 @@ client = MongoClient("mongodb://localhost:27017/")
 db = client["aadhar"]
 collection = db["coll_candidates"]
 verification_collection = db["verification_results"]
+collection.create_index([("aadhar_number", ASCENDING)])
 
 extractor = PaddleAadhaarExtractor()
 
+# Batch runs upsert verification results with one bulk_write per WRITE_BATCH records
+WRITE_BATCH = 500
+
+def save_results(results):
+    if not results:
+        return
+    try:
+        verification_collection.bulk_write(
+            [ReplaceOne({"decoded_aadhaar": r["decoded_aadhaar"]}, r, upsert=True) for r in results],
+            ordered=False
+        )
+    except Exception as e:
+        logging.warning(f"⚠️ Error saving {len(results)} results: {e}")
+
 def generate_ref_number(decoded_aadhaar):
     url = 'https://aadhar.trti-maha.in:8080/'
     data = {
@@ -36,7 +49,7 @@ def generate_ref_number(decoded_aadhaar):
         'entered_opr': 'struid'
     }
     try:
-        response = requests.post(url, data=data, timeout=30, verify=False)
+        response = http_session.post(url, data=data, timeout=30, verify=False)
         response.raise_for_status()
         return response.json().get("refnum", "N/A")
     except Exception as e:
@@ -65,44 +78,39 @@ def upload_and_extract():
         file.save(file_path)
         logging.info(f"✅ File uploaded: {filename}")
 
-        partial_extracted = extractor.extract_from_file(file_path, record=None)
+        # OCR runs once: the second extraction below reuses these page lines with the matched record
+        ocr_cache = {}
+        partial_extracted = extractor.extract_from_file(file_path, record=None, ocr_cache=ocr_cache)
         aadhaar_number = partial_extracted.get("Aadhaar Number", "")
         if not aadhaar_number or len(aadhaar_number) != 12:
             return jsonify({"error": "Aadhaar number not detected or invalid"}), 422
 
-        matched_record = None
-        for candidate in collection.find({}):
-            decoded = decode_base64_aadhaar(candidate.get("aadhar_number", ""))
-            if decoded == aadhaar_number:
-                matched_record = candidate
-                break
+        # Candidates store the number base64-encoded, so encode once and use the aadhar_number index
+        b64key = base64.b64encode(aadhaar_number.encode()).decode()
+        matched_record = collection.find_one({"aadhar_number": b64key}, RECORD_PROJECTION)
 
         if not matched_record:
             return jsonify({"error": f"Aadhaar number {aadhaar_number} not found in DB"}), 404
 
-        extracted = extractor.extract_from_file(file_path, matched_record)
+        extracted = extractor.extract_from_file(file_path, matched_record, ocr_cache=ocr_cache)
         result = verify_fields(extracted, matched_record)
 
-        try:
-            raw_lines = extractor.last_raw_ocr_result
-            confidences = [line[1][1] for block in raw_lines for line in block if line[1][0].strip()]
-            avg_confidence = float(np.mean(confidences)) if confidences else 0.0
-        except:
-            avg_confidence = 0.0
+        avg_confidence = ocr_confidence(extractor.last_raw_ocr_result)
 
         decision = result.get("decision", "Manual_Review")
         status = "Verified" if decision.lower() == "accept" else "Not Verified"
 
         refnum = "N/A"
         if decision.lower() == "accept":
-            decoded_uid = decode_base64_aadhaar(matched_record.get("aadhar_number", ""))
-            refnum = generate_ref_number(decoded_uid)
+            decoded_uid = record_decoded_aadhaar(matched_record)
+            # A ref number already stored for this Aadhaar (e.g. by a batch run) is reused instead of calling the API
+            stored = verification_collection.find_one(
+                {"decoded_aadhaar": decoded_uid, "aadhaar_refnum": {"$exists": True, "$nin": ["notavailable", "N/A", "Error"]}},
+                {"_id": 0, "aadhaar_refnum": 1}
+            )
+            refnum = stored["aadhaar_refnum"] if stored else generate_ref_number(decoded_uid)
 
-        dob_raw = extracted.get("DOB", "")
-        try:
-            dob_formatted = datetime.strptime(dob_raw, "%Y-%m-%d").strftime("%d-%b-%Y")
-        except:
-            dob_formatted = dob_raw
+        dob_formatted = format_dob(extracted.get("DOB", ""))
 
         response_data = {
             "auth_id": matched_record.get("auth_id", "N/A"),
@@ -144,11 +152,9 @@ def upload_and_extract():
         except Exception as e:
             logging.warning(f"⚠️ Could not delete file: {file_path} — {e}")
 
-def verify_single(record):
+def verify_single(record, extracted):
     try:
-        aadhaar_url = f"https://cpetp.trti-maha.in/{record.get('aadhaar_doc', '')}"
-        extracted = extractor.extract_from_file(aadhaar_url, record)
-        record["decoded_aadhaar"] = decode_base64_aadhaar(record.get("aadhar_number", ""))
+        record_decoded_aadhaar(record)
         result = verify_fields(extracted, record)
 
         result_entry = {
@@ -158,13 +164,6 @@ def verify_single(record):
             "match_result": result,
             "timestamp": datetime.utcnow()
         }
-
-        verification_collection.replace_one(
-            {"decoded_aadhaar": record["decoded_aadhaar"]},
-            result_entry,
-            upsert=True
-        )
-
         return result_entry
 
     except Exception as e:
@@ -174,16 +173,23 @@ def verify_single(record):
 @app.route("/run-batch-now", methods=["POST"])
 def run_batch_now():
     logging.info("🟡 Manual batch verification triggered.")
-    applicants = list(collection.find({}))
-    results = []
-    with ThreadPoolExecutor(max_workers=4) as executor:
-        futures = [executor.submit(verify_single, record) for record in applicants]
-        for future in as_completed(futures):
-            result = future.result()
+    processed = 0
+    pending = []
+    # Candidates are streamed off the cursor and results saved every WRITE_BATCH, so memory stays flat
+    with collection.find({}, RECORD_PROJECTION, no_cursor_timeout=True).batch_size(500) as applicants:
+        # Download/render, OCR and verification overlap through the extractor's pipeline; 4 OCR threads share the records
+        sources = ((f"https://cpetp.trti-maha.in/{record.get('aadhaar_doc', '')}", record) for record in applicants)
+        for record, extracted, _ in extractor.pipeline(sources, ocr_workers=4):
+            result = verify_single(record, extracted)
             if result:
-                results.append(result)
-    logging.info(f"✅ Batch verification done: {len(results)} records")
-    return jsonify({"message": "Batch verification completed", "processed": len(results)}), 200
+                processed += 1
+                pending.append(result)
+                if len(pending) >= WRITE_BATCH:
+                    save_results(pending)
+                    pending = []
+    save_results(pending)
+    logging.info(f"✅ Batch verification done: {processed} records")
+    return jsonify({"message": "Batch verification completed", "processed": processed}), 200
 
 if __name__ == "__main__":
     app.run(host="0.0.0.0", port=8000, debug=False)
\ No newline at end of file
@@ -1,17 +1,14 @@
 from flask import Flask, request, jsonify
 from flask_apscheduler import APScheduler
-from aadhaar_verifier import PaddleAadhaarExtractor, verify_fields, decode_base64_aadhaar
-from pymongo import MongoClient
-from concurrent.futures import ThreadPoolExecutor, as_completed
+from aadhaar_verifier import PaddleAadhaarExtractor, verify_fields, record_decoded_aadhaar, RECORD_PROJECTION
+from pymongo import MongoClient, ReplaceOne
 from datetime import datetime
 import logging
-import numpy as np
-import time
-import requests
 
 app = Flask(__name__)
 scheduler = APScheduler()
 logging.getLogger("ppocr").setLevel(logging.ERROR)
+logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
 
 # MongoDB setup
 client = MongoClient("mongodb://localhost:27017/")
@@ -21,6 +18,20 @@ verification_collection = db["verification_results"]
 
 extractor = PaddleAadhaarExtractor()
 
+# Batch runs upsert verification results with one bulk_write per WRITE_BATCH records
+WRITE_BATCH = 500
+
+def save_results(results):
+    if not results:
+        return
+    try:
+        verification_collection.bulk_write(
+            [ReplaceOne({"decoded_aadhaar": r["decoded_aadhaar"]}, r, upsert=True) for r in results],
+            ordered=False
+        )
+    except Exception as e:
+        logging.warning(f"⚠️ Error saving {len(results)} results: {e}")
+
 class Config:
     SCHEDULER_API_ENABLED = True
 app.config.from_object(Config())
@@ -31,11 +42,9 @@ def index():
     return "Aadhaar API with APScheduler (Windows safe) is running."
 
 # 🧠 Verification logic
-def verify_single(record):
+def verify_single(record, extracted):
     try:
-        aadhaar_url = f"https://cpetp.trti-maha.in/{record.get('aadhaar_doc', '')}"
-        extracted = extractor.extract_from_file(aadhaar_url, record)
-        record["decoded_aadhaar"] = decode_base64_aadhaar(record.get("aadhar_number", ""))
+        record_decoded_aadhaar(record)
         result = verify_fields(extracted, record)
         result_entry = {
             "auth_id": record.get("auth_id"),
@@ -44,11 +53,6 @@ def verify_single(record):
             "match_result": result,
             "timestamp": datetime.utcnow()
         }
-        verification_collection.replace_one(
-            {"decoded_aadhaar": record["decoded_aadhaar"]},
-            result_entry,
-            upsert=True
-        )
         return result_entry
     except Exception as e:
         logging.error(f"Verification error: {e}")
@@ -58,15 +62,22 @@ def verify_single(record):
 @scheduler.task("cron", id="aadhaar_batch_daily", hour=0, minute=0)
 def scheduled_verification():
     logging.info("🕐 Running scheduled Aadhaar verification")
-    applicants = list(collection.find({}))
-    results = []
-    with ThreadPoolExecutor(max_workers=4) as executor:
-        futures = [executor.submit(verify_single, record) for record in applicants]
-        for future in as_completed(futures):
-            result = future.result()
+    processed = 0
+    pending = []
+    # Candidates are streamed off the cursor and results saved every WRITE_BATCH, so memory stays flat
+    with collection.find({}, RECORD_PROJECTION, no_cursor_timeout=True).batch_size(500) as applicants:
+        # Download/render, OCR and verification overlap through the extractor's pipeline; 4 OCR threads share the records
+        sources = ((f"https://cpetp.trti-maha.in/{record.get('aadhaar_doc', '')}", record) for record in applicants)
+        for record, extracted, _ in extractor.pipeline(sources, ocr_workers=4):
+            result = verify_single(record, extracted)
             if result:
-                results.append(result)
-    logging.info(f"✅ Finished scheduled verification — {len(results)} records processed")
+                processed += 1
+                pending.append(result)
+                if len(pending) >= WRITE_BATCH:
+                    save_results(pending)
+                    pending = []
+    save_results(pending)
+    logging.info(f"✅ Finished scheduled verification — {processed} records processed")
 
 # 🔘 Manual trigger
 @app.route("/run-batch-now", methods=["POST"])